@@ -1,11 +1,14 @@
 """Server-side rendering for AMP HTML in Python."""
 
 # Standard Library
-import contextlib
+import functools
+import hashlib
+import io
 import json
 import re
+import sys
 import types
-from collections import OrderedDict, namedtuple
+from collections import defaultdict, namedtuple
 from enum import Enum
 from html.parser import HTMLParser
 
@@ -14,6 +17,11 @@ class TransformationError(Exception):
     """An error to throw when attributes can't be converted to CSS."""
 
 
+# Escape table for attribute values; `str.translate` beats `str.replace` for
+# single-character substitutions.
+_QUOTE_ESCAPE = str.maketrans({'"': "&quot;"})
+
+
 # The namedtuples will still be accessed using index notation for performance.
 Translation = namedtuple("Translation", "selector statements")
 Sizes = namedtuple("Size", "default other")
@@ -21,66 +29,103 @@ Media = namedtuple("Media", "query value")
 Sizer = namedtuple("Sizer", "attrs maybe_img_attrs")
 
 
+# Identical attribute values repeat across similar elements, so the parse
+# work is cached on the raw value. Cached results must never be mutated.
+@functools.lru_cache(maxsize=1024)
+def _parse_sizes(value):
+    """Parse the value of a `sizes=...`-style attribute."""
+    # Normalize whitespace
+    size_values = [size_value.strip() for size_value in value.split(",")]
+
+    try:
+        default = size_values.pop()
+    except IndexError:
+        return ""
+
+    other = []
+
+    for size_value in size_values:
+        size_parts = size_value.split(")", 1)
+        if len(size_parts) != 2 or not size_parts[1]:
+            raise ValueError("Invalid sizes definition")
+
+        # Only a simple `(condition) value` pair is supported: reject
+        # compound conditions with further parens and require whitespace
+        # between the condition and the value, as the regex split this
+        # replaced did.
+        remainder = size_parts[1]
+        if ")" in remainder or not remainder[0].isspace():
+            raise ValueError("Invalid sizes definition")
+
+        query = f"{size_parts[0]})"
+        query = query.replace(r"\s+", "")
+
+        media = Media(query=query, value=size_parts[1].strip())
+        other.append(media)
+
+    return Sizes(default=default, other=other)
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_media_query(value):
+    """Normalize a `media=...` attribute into an inverted media query."""
+    # Normalize whitespace
+    media = " ".join(value.split())
+
+    if not media:
+        return None
+
+    if media[0] == "(":
+        media = f"all and {media}"
+
+    if media.startswith("not "):
+        return media[4:]
+
+    return f"not {media}"
+
+
 class Translator:
     """A tool to convert special attributes to CSS."""
 
     @classmethod
     def parse_sizes(cls, value):
         """Parse the value of a special attribute."""
-        # Normalize whitespace
-        size_values = re.split(r"\s*,\s*", value.strip())
-
-        try:
-            default = size_values.pop()
-        except IndexError:
-            return ""
+        return _parse_sizes(value)
 
-        other = []
-
-        for size_value in size_values:
-            size_parts = re.split(r"\)\s+", size_value)
-            if len(size_parts) != 2:
-                raise ValueError("Invalid sizes definition")
-
-            query = f"{size_parts[0]})"
-            query = query.replace(r"\s+", "")
-            value = size_parts[1]
+    @classmethod
+    def _translate_sizes(cls, value, selector, css_property):
+        """Convert a parsed sizes-style attribute to CSS statements.
+
+        The user agent will pick a value from the attribute, using the
+        first item with a <media-condition> (the part in parentheses) that
+        evaluates to true. This means, we have to reverse the order of the
+        media queries in CSS to emulate this behavior (the last definition
+        has precedence). Iterate in reverse rather than reversing in
+        place; the parsed result is cached and must stay pristine.
+        """
+        sizes = cls.parse_sizes(value)
 
-            media = Media(query=query, value=value)
-            other.append(media)
+        statements = {None: f"{css_property}:{sizes[0]}"}
+        for size in reversed(sizes[1]):
+            statements[size[0]] = f"{css_property}:{size[1]}"
 
-        return Sizes(default=default, other=other)
+        return Translation(selector=selector, statements=statements)
 
 
 class MediaTranslator(Translator):
     """A tool to convert `media=...` attributes to CSS."""
 
     @classmethod
-    def translate(cls, value, element_id):
+    def translate(cls, value, selector):
         """Convert a `media=...` attribute to CSS."""
-        # Normalize whitespace
-        media = re.sub(r"\s+", " ", value).strip()
+        media = _parse_media_query(value)
 
-        if not media:
+        if media is None:
             return None
 
-        if media[0] == "(":
-            media = f"all and {media}"
-
-        if media.startswith("not "):
-            media = media[4:]
-        else:
-            media = f"not {media}"
-
-        selector = f"#{element_id}"
-
         return Translation(
             selector=selector,
-            statements=OrderedDict(
-                [
-                    (media, "display:none"),
-                ],
-            ),
+            statements={media: "display:none"},
         )
 
 
@@ -88,47 +133,18 @@ class SizesTranslator(Translator):
     """A tool to convert `sizes=...` attributes to CSS."""
 
     @classmethod
-    def translate(cls, value, element_id):
+    def translate(cls, value, selector):
         """Convert a `sizes=...` attribute to CSS."""
-        sizes = cls.parse_sizes(value)
-        selector = f"#{element_id}"
-        statements = [(None, f"width:{sizes[0]}")]
-        other_sizes = sizes[1]
-
-        # The user agent will pick a width from the sizes attribute, using the
-        # first item with a <media-condition> (the part in parentheses) that
-        # evaluates to true. This means, we have to reverse the order the media
-        # queries in CSS to emulate this behavior (the last definition has
-        # precedence).
-        other_sizes.reverse()
-
-        for size in other_sizes:
-            statements.append((size[0], f"width:{size[1]}"))
-
-        return Translation(selector=selector, statements=OrderedDict(statements))
+        return cls._translate_sizes(value, selector, "width")
 
 
 class HeightsTranslator(Translator):
     """A tool to convert `heights=...` attributes to CSS."""
 
     @classmethod
-    def translate(cls, value, element_id):
+    def translate(cls, value, selector):
         """Convert a `heights=...` attribute to CSS."""
-        sizes = cls.parse_sizes(value)
-        selector = f"#{element_id}>:first-child"
-        statements = [(None, f"padding-top:{sizes[0]}")]
-        other_sizes = sizes[1]
-
-        # The user agent will pick a value from the heights attribute, using
-        # the first item with a <media-condition> (the part in parentheses)
-        # that evaluates to true. This means, we have to reverse the order the
-        # media queries in CSS to emulate this behavior (the last definition
-        # has precedence).
-        other_sizes.reverse()
-        for size in other_sizes:
-            statements.append((size[0], f"padding-top:{size[1]}"))
-
-        return Translation(selector=selector, statements=OrderedDict(statements))
+        return cls._translate_sizes(value, f"{selector}>:first-child", "padding-top")
 
 
 TRANSLATIONS = types.MappingProxyType(
@@ -139,6 +155,9 @@ TRANSLATIONS = types.MappingProxyType(
     },
 )
 
+# Iterating these three keys beats scanning every attribute of an element.
+_TRANSLATION_KEYS = tuple(TRANSLATIONS)
+
 
 class Layout(Enum):
     """Possible layout options for an AMP html element."""
@@ -154,7 +173,7 @@ class Layout(Enum):
 
     def get_class(self):
         """Return the CSS class appropriate for this layout."""
-        return f"i-amphtml-layout-{self.value}"
+        return _LAYOUT_CLASSES[self]
 
     def is_size_defined(self):
         """Return whether this layout has its size defined."""
@@ -171,15 +190,23 @@ LAYOUT_FILL = Layout.FILL
 LAYOUT_FLEX_ITEM = Layout.FLEX_ITEM
 LAYOUT_INTRINSIC = Layout.INTRINSIC
 
-SIZE_DEFINED_LAYOUTS = (
-    LAYOUT_FIXED,
-    LAYOUT_FIXED_HEIGHT,
-    LAYOUT_RESPONSIVE,
-    LAYOUT_FILL,
-    LAYOUT_FLEX_ITEM,
-    LAYOUT_INTRINSIC,
+SIZE_DEFINED_LAYOUTS = frozenset(
+    (
+        LAYOUT_FIXED,
+        LAYOUT_FIXED_HEIGHT,
+        LAYOUT_RESPONSIVE,
+        LAYOUT_FILL,
+        LAYOUT_FLEX_ITEM,
+        LAYOUT_INTRINSIC,
+    ),
 )
 
+# One dict lookup is cheaper than Enum's value->member dispatch.
+_LAYOUT_BY_VALUE = {layout.value: layout for layout in Layout}
+
+# Precomputed so `get_class` doesn't format the same string per element.
+_LAYOUT_CLASSES = {layout: f"i-amphtml-layout-{layout.value}" for layout in Layout}
+
 
 class CSSLengthUnit(Enum):
     """Possible unit strings for a CSS length value."""
@@ -196,26 +223,163 @@ class CSSLengthUnit(Enum):
 # Store constant for performance
 UNIT_PX = CSSLengthUnit.PX
 
+# One dict lookup is cheaper than Enum's value->member dispatch.
+_CSS_UNIT_BY_VALUE = {unit.value: unit for unit in CSSLengthUnit}
+
 # The namedtuples will still be accessed using index notation for performance.
 CSSLength = namedtuple("CSSLength", "numeral unit")
 CSS_LENGTH_AUTO = "auto"
 CSS_LENGTH_ONE_PX = CSSLength(numeral=1, unit=UNIT_PX)
 
 
+# Default dimensions for tags that may omit width/height attributes
+_DEFAULT_WIDTHS = {
+    "amp-analytics": CSS_LENGTH_ONE_PX,
+    "amp-audio": CSS_LENGTH_AUTO,
+    "amp-pixel": CSS_LENGTH_ONE_PX,
+    "amp-social-share": CSSLength(numeral=60, unit=UNIT_PX),
+}
+
+_DEFAULT_HEIGHTS = {
+    "amp-analytics": CSS_LENGTH_ONE_PX,
+    "amp-audio": CSS_LENGTH_AUTO,
+    "amp-pixel": CSS_LENGTH_ONE_PX,
+    "amp-social-share": CSSLength(numeral=44, unit=UNIT_PX),
+}
+
+# Attributes to copy onto the server-rendered img for data-hero amp-imgs
+_HERO_COPY_ATTRS = frozenset(
+    (
+        "alt",
+        "attribution",
+        "object-fit",
+        "object-position",
+        "referrerpolicy",
+        "src",
+        "srcset",
+        "sizes",
+        "title",
+    ),
+)
+
+
+@functools.lru_cache(maxsize=512)
+def _parse_length(length):
+    """Parse a width/height value into a CSSLength.
+
+    Pages repeat the same handful of dimension values, so results are
+    memoized on the raw string. Invalid values raise TransformationError
+    and stay uncached.
+    """
+    if not length:
+        return None
+
+    if length == "auto":
+        return CSS_LENGTH_AUTO
+
+    # Fast paths for the overwhelmingly common integer-pixel values; the
+    # isascii check rules out the non-ASCII digits that pass isdigit but
+    # that float() rejects.
+    if length.isascii():
+        if length.isdigit():
+            return CSSLength(numeral=float(length), unit=UNIT_PX)
+
+        if length.endswith("px") and length[:-2].isdigit():
+            return CSSLength(numeral=float(length[:-2]), unit=UNIT_PX)
+
+    # Scan the numeric prefix (digits with an optional fraction) by hand;
+    # the values are short enough that this beats the regex engine per
+    # call.
+    index = 0
+    length_size = len(length)
+    while index < length_size and length[index].isdigit():
+        index += 1
+
+    if not index:
+        raise TransformationError("Invalid size value")
+
+    if index < length_size and length[index] == ".":
+        fraction_start = index + 1
+        index = fraction_start
+        while index < length_size and length[index].isdigit():
+            index += 1
+
+        if index == fraction_start:
+            # A bare trailing dot isn't part of the number
+            index = fraction_start - 1
+
+    try:
+        # str.isdigit accepts characters like superscripts that float()
+        # rejects, so the conversion still needs a guard.
+        numeral = float(length[:index])
+    except ValueError:
+        raise TransformationError("Invalid size value")
+
+    unit = _CSS_UNIT_BY_VALUE.get(length[index:] or "px")
+    if unit is None:
+        raise TransformationError("Invalid size value")
+
+    return CSSLength(numeral=numeral, unit=unit)
+
+
+def _serialize_attrs(attrs, should_trim=False, should_sort=False):
+    """Turn attribute tuples into a single HTML attribute string.
+
+    Kept at module level; this runs for every tag in the document, and a
+    plain function call is the cheapest dispatch available.
+    """
+    attr_strings = []
+    for name, attr_value in attrs:
+        # Names are almost always lowercase already; skip the copy then.
+        attr_name = name if name.islower() else name.lower()
+        if attr_value is None:
+            attr_strings.append(f" {attr_name}")
+        else:
+            value = str(attr_value)
+            if should_trim:
+                value = value.strip()
+            value = value.translate(_QUOTE_ESCAPE)
+            attr_strings.append(f' {attr_name}="{value}"')
+
+    if should_sort:
+        # Sort alphabetically for diffing
+        attr_strings.sort()
+
+    return "".join(attr_strings)
+
+
+@functools.lru_cache(maxsize=512)
+def _format_numeral(numeral):
+    """Format a CSS numeral without a trailing `.0`.
+
+    Formatted once per distinct value; dimensions repeat heavily across
+    the elements of a page.
+    """
+    if numeral == int(numeral):
+        return str(int(numeral))
+    return str(numeral)
+
+
 class AMPNode:
     """Store an AMP-specific HTML element."""
 
+    __slots__ = (
+        "_classes",
+        "_is_hidden",
+        "_is_transformed",
+        "_other_attrs",
+        "_style",
+        "element_id",
+        "maybe_img_attrs",
+        "sizer",
+        "strip_translated_attrs",
+        "tag",
+    )
+
     def __init__(self, tag, attrs):
         """Set up default attributes of an AMP-specific HTML element."""
         self.tag = tag
 
-        self.element_id = None
-
-        self._classes = []
-        self._style = ""
-        self._is_hidden = False
-
-        self._other_attrs = {}
         self._is_transformed = False
 
         self.sizer = None
@@ -223,18 +387,23 @@ class AMPNode:
 
         self.strip_translated_attrs = True
 
-        for attr in attrs:
-            if attr[0] == "id":
-                self.element_id = attr[1]
-            elif attr[0] == "class":
-                self._classes = attr[1].split(" ")
-            elif attr[0] == "style":
-                self._style = attr[1]
-            elif attr[0] == "hidden":
-                self._is_hidden = True
-            else:
-                # Should be only one value per key
-                self._other_attrs[attr[0]] = attr[1]
+        # Should be only one value per key; dict() keeps the last one, just
+        # like the attribute loop it replaced.
+        other_attrs = dict(attrs)
+
+        self.element_id = other_attrs.pop("id", None)
+
+        class_value = other_attrs.pop("class", None)
+        self._classes = class_value.split(" ") if class_value else []
+
+        # A valueless style attribute is stored as None; coerce it here so
+        # the layout handlers can concatenate without a branch.
+        self._style = other_attrs.pop("style", None) or ""
+
+        self._is_hidden = "hidden" in other_attrs
+        other_attrs.pop("hidden", None)
+
+        self._other_attrs = other_attrs
 
     def transform(self, next_auto_id):
         """Apply the transformation.
@@ -250,20 +419,9 @@ class AMPNode:
                 ("decoding", "async"),
             ]
 
-            attrs_to_copy = (
-                "alt",
-                "attribution",
-                "object-fit",
-                "object-position",
-                "referrerpolicy",
-                "src",
-                "srcset",
-                "sizes",
-                "title",
-            )
-            attrs_to_copy = (attr for attr in attrs_to_copy if attr in self._other_attrs)
-            for attr in attrs_to_copy:
-                img_attrs.append((attr, self._other_attrs[attr]))
+            for attr_name, attr_value in self._other_attrs.items():
+                if attr_name in _HERO_COPY_ATTRS:
+                    img_attrs.append((attr_name, attr_value))
 
             self.maybe_img_attrs = img_attrs
 
@@ -271,41 +429,51 @@ class AMPNode:
         css_data = None
         did_strip_sizes = False
 
-        translations = [attr for attr in self._other_attrs if attr in TRANSLATIONS]
+        translations = [key for key in _TRANSLATION_KEYS if key in self._other_attrs]
         if translations:
-            potential_id = self.element_id or next_auto_id
+            # Sizes is meant to be passed to the img tag for source selection;
+            # with `disable-inline-width` the user didn’t intend for it to
+            # have any side effects, so rule it out before doing any work.
+
+            # https://amp.dev/documentation/guides-and-tutorials/learn/amp-html-layout/?format=websites
+            effective_translations = [
+                key
+                for key in translations
+                if not (key == "sizes" and "disable-inline-width" in self._other_attrs)
+            ]
 
-            css_data_items = []
-            for attr_to_translate in translations:
-                if attr_to_translate == "sizes" and "disable-inline-width" in self._other_attrs:
-                    # Sizes is meant to be passed to the img tag for source
-                    # selection, but the user didn’t intend for it to have any
-                    # side effects. Don’t add any.
+            if effective_translations:
+                potential_id = self.element_id or next_auto_id
 
-                    # https://amp.dev/documentation/guides-and-tutorials/learn/amp-html-layout/?format=websites
-                    continue
+                # Build the base selector once; every translator shares it.
+                selector = f"#{potential_id}"
 
-                attribute_value = self._other_attrs[attr_to_translate]
-                translator = TRANSLATIONS[attr_to_translate]
+                css_data_items = []
+                for attr_to_translate in effective_translations:
+                    attribute_value = self._other_attrs[attr_to_translate]
+                    translator = TRANSLATIONS[attr_to_translate]
 
-                try:
-                    translation = translator.translate(attribute_value, potential_id)
-                except ValueError:
-                    raise TransformationError(f"Invalid value for `{attr_to_translate}` attribute")
-                else:
-                    if translation:
-                        css_data_items.append(translation)
-                        if attr_to_translate == "sizes":
-                            # Need to know so we can apply "responsive" layout
-                            did_strip_sizes = True
+                    try:
+                        translation = translator.translate(attribute_value, selector)
+                    except ValueError:
+                        raise TransformationError(
+                            f"Invalid value for `{attr_to_translate}` attribute",
+                        )
+                    else:
+                        if translation:
+                            css_data_items.append(translation)
+                            if attr_to_translate == "sizes":
+                                # Need to know so we can apply "responsive"
+                                # layout
+                                did_strip_sizes = True
 
-            if css_data_items:
-                used_auto_id = False
-                if not self.element_id:
-                    used_auto_id = True
-                    self.element_id = potential_id
+                if css_data_items:
+                    used_auto_id = False
+                    if not self.element_id:
+                        used_auto_id = True
+                        self.element_id = potential_id
 
-                css_data = css_data_items, used_auto_id
+                    css_data = css_data_items, used_auto_id
 
             if self.strip_translated_attrs:
                 for attr_to_translate in translations:
@@ -316,29 +484,16 @@ class AMPNode:
         layout_value = self._other_attrs.get("layout")
 
         width = self._parse_length(self._other_attrs.get("width"))
-        if not isinstance(width, CSSLength) and layout_value in {None, "fixed"}:
-            with contextlib.suppress(KeyError):
-                width = {
-                    "amp-analytics": CSS_LENGTH_ONE_PX,
-                    "amp-audio": CSS_LENGTH_AUTO,
-                    "amp-pixel": CSS_LENGTH_ONE_PX,
-                    "amp-social-share": CSSLength(numeral=60, unit=UNIT_PX),
-                }[self.tag]
+        if type(width) is not CSSLength and layout_value in {None, "fixed"}:
+            width = _DEFAULT_WIDTHS.get(self.tag, width)
 
         height = self._parse_length(self._other_attrs.get("height"))
-        if not isinstance(height, CSSLength) and layout_value in {None, "fixed", "fixed-height"}:
-            social_share_height_px = 44
-            with contextlib.suppress(KeyError):
-                height = {
-                    "amp-analytics": CSS_LENGTH_ONE_PX,
-                    "amp-audio": CSS_LENGTH_AUTO,
-                    "amp-pixel": CSS_LENGTH_ONE_PX,
-                    "amp-social-share": CSSLength(numeral=social_share_height_px, unit=UNIT_PX),
-                }[self.tag]
+        if type(height) is not CSSLength and layout_value in {None, "fixed", "fixed-height"}:
+            height = _DEFAULT_HEIGHTS.get(self.tag, height)
 
         if not layout_value:
-            width_is_set = isinstance(width, CSSLength)
-            height_is_set = isinstance(height, CSSLength)
+            width_is_set = type(width) is CSSLength
+            height_is_set = type(height) is CSSLength
 
             if not width_is_set and not height_is_set:
                 layout_value = "container"
@@ -354,61 +509,37 @@ class AMPNode:
             else:
                 layout_value = "fixed"
 
-        try:
-            layout = Layout(layout_value)
-        except ValueError:
+        layout = _LAYOUT_BY_VALUE.get(layout_value)
+        if layout is None:
             raise TransformationError("Transformation not supported")
 
         self._classes.append(layout.get_class())
         if layout.is_size_defined():
             self._classes.append("i-amphtml-layout-size-defined")
 
-        if layout == LAYOUT_NODISPLAY:
-            self._is_hidden = True
-
-        elif layout == LAYOUT_FIXED:
-            if not all(isinstance(length, CSSLength) for length in (width, height)):
-                raise TransformationError("Length and width required for fixed layout")
+        # Build each style fragment once; the layout handlers only
+        # concatenate.
+        width_frag = None
+        if type(width) is CSSLength:
+            width_frag = f"width:{_format_numeral(width[0])}{width[1].value};"
 
-            self._style = "width:{}{};height:{}{};{}".format(
-                str(width[0]).rstrip("0").rstrip("."),
-                width[1].value,
-                str(height[0]).rstrip("0").rstrip("."),
-                height[1].value,
-                self._style,
-            )
+        height_frag = None
+        if type(height) is CSSLength:
+            height_frag = f"height:{_format_numeral(height[0])}{height[1].value};"
 
-        elif layout == LAYOUT_FIXED_HEIGHT:
-            if not isinstance(height, CSSLength):
-                raise TransformationError("Length and width required for fixed layout")
-
-            self._style = "height:{}{};{}".format(
-                str(height[0]).rstrip("0").rstrip("."),
-                height[1].value,
-                self._style,
-            )
-
-        elif layout == LAYOUT_FLEX_ITEM:
-            if isinstance(height, CSSLength):
-                self._style = "height:{}{};{}".format(
-                    str(height[0]).rstrip("0").rstrip("."),
-                    height[1].value,
-                    self._style,
-                )
-
-            if isinstance(width, CSSLength):
-                self._style = "width:{}{};{}".format(
-                    str(width[0]).rstrip("0").rstrip("."),
-                    width[1].value,
-                    self._style,
-                )
+        layout_handler = self._LAYOUT_HANDLERS.get(layout)
+        if layout_handler:
+            layout_handler(self, width_frag, height_frag)
 
         self._other_attrs["i-amphtml-layout"] = layout.value
 
         # Create sizer if necessary
-        create_sizer = all(
-            isinstance(length, CSSLength) for length in (width, height)
-        ) and all([width[0] != 0, width[1] == height[1]])
+        create_sizer = (
+            type(width) is CSSLength
+            and type(height) is CSSLength
+            and width[0] != 0
+            and width[1] == height[1]
+        )
         if create_sizer:
             if layout == LAYOUT_RESPONSIVE:
                 padding = (height[0] / width[0]) * 100
@@ -417,10 +548,9 @@ class AMPNode:
 
             elif layout == LAYOUT_INTRINSIC:
                 svg_string = (
-                    '<svg height="{}" width="{}" xmlns="http://www.w3.org/2000/svg"'
-                    + ' version="1.1"/>'
+                    f'<svg height="{height[0]}" width="{width[0]}"'
+                    + ' xmlns="http://www.w3.org/2000/svg" version="1.1"/>'
                 )
-                svg_string = svg_string.format(height[0], width[0])
 
                 img_attrs = [
                     ("alt", ""),
@@ -437,6 +567,36 @@ class AMPNode:
 
         return css_data
 
+    def _apply_nodisplay(self, width_frag, height_frag):
+        self._is_hidden = True
+
+    def _apply_fixed(self, width_frag, height_frag):
+        if width_frag is None or height_frag is None:
+            raise TransformationError("Length and width required for fixed layout")
+
+        self._style = width_frag + height_frag + self._style
+
+    def _apply_fixed_height(self, width_frag, height_frag):
+        if height_frag is None:
+            raise TransformationError("Length and width required for fixed layout")
+
+        self._style = height_frag + self._style
+
+    def _apply_flex_item(self, width_frag, height_frag):
+        if height_frag is not None:
+            self._style = height_frag + self._style
+
+        if width_frag is not None:
+            self._style = width_frag + self._style
+
+    # One lookup replaces the equality cascade over the layout members.
+    _LAYOUT_HANDLERS = {  # noqa: WPS115 (class-level dispatch table)
+        LAYOUT_NODISPLAY: _apply_nodisplay,
+        LAYOUT_FIXED: _apply_fixed,
+        LAYOUT_FIXED_HEIGHT: _apply_fixed_height,
+        LAYOUT_FLEX_ITEM: _apply_flex_item,
+    }
+
     def get_attrs(self):
         """Return an list of attribute tuples that represents current state.
 
@@ -468,25 +628,7 @@ class AMPNode:
 
         This utility function is stateless.
         """
-        if not length:
-            return None
-
-        if length == "auto":
-            return CSS_LENGTH_AUTO
-
-        try:
-            match = re.findall(r"(\d+(?:\.\d+)?)(.*)", length)[0]
-            numeral = float(match[0])
-        except (IndexError, ValueError):
-            raise TransformationError("Invalid size value")
-
-        unit_value = match[1] or "px"
-        try:
-            unit = CSSLengthUnit(unit_value)
-        except ValueError:
-            raise TransformationError("Invalid size value")
-
-        return CSSLength(numeral=numeral, unit=unit)
+        return _parse_length(length)
 
 
 RENDER_DELAYING_EXTENSIONS = (
@@ -497,6 +639,49 @@ RENDER_DELAYING_EXTENSIONS = (
 
 ID_PREFIX = "i-amp-"
 
+_CONFLICT_ID_RE = re.compile(r"id=['\"]?" + re.escape(ID_PREFIX) + r"([0-9]+)['\"]?")
+
+# In-stream placeholders for content that can only be resolved once parsing
+# has finished. Each is spliced out (or blanked) in `render()`; the NUL
+# bytes keep them from colliding with real document text.
+_TRANSLATED_STYLES_PLACEHOLDER = "\x00amp-translated-styles\x00"
+_BOILERPLATE_PLACEHOLDER = "\x00amp-boilerplate\x00"
+_NOSCRIPT_BOILERPLATE_PLACEHOLDER = "\x00amp-noscript-boilerplate\x00"
+
+_NO_BOILERPLATE_MARKER = " i-amphtml-no-boilerplate"
+_EMPTY_NOSCRIPT = "<noscript></noscript>"
+
+# The noscript boilerplate placeholder always sits inside a noscript tag
+# that must disappear along with it, so the wrapped form gets its own
+# alternative ahead of the bare ones.
+_WRAPPED_NOSCRIPT_PLACEHOLDER = (
+    "<noscript>" + _NOSCRIPT_BOILERPLATE_PLACEHOLDER + "</noscript>"
+)
+
+# One alternation keeps the restored-boilerplate cleanup to a single pass
+# over the final document.
+_CLEANUP_RE = re.compile(_NO_BOILERPLATE_MARKER + "|" + _EMPTY_NOSCRIPT)
+
+# Full finalize pass: placeholders and cleanup markers, all resolved in a
+# single scan of the document.
+_FINALIZE_RE = re.compile(
+    "|".join((
+        _TRANSLATED_STYLES_PLACEHOLDER,
+        _BOILERPLATE_PLACEHOLDER,
+        _WRAPPED_NOSCRIPT_PLACEHOLDER,
+        _NOSCRIPT_BOILERPLATE_PLACEHOLDER,
+        _NO_BOILERPLATE_MARKER,
+        _EMPTY_NOSCRIPT,
+    )),
+)
+
+# Bounded size for the per-instance render memo
+_RENDER_CACHE_SIZE = 128
+
+_AMP_CUSTOM_OPEN = "<style amp-custom>"
+_BOILERPLATE_OPEN = "<style amp-boilerplate>"
+_STYLE_CLOSE = "</style>"
+
 
 class AMPRenderer(HTMLParser):
     """A parser to ingest AMP HTML and perform various transformations."""
@@ -524,6 +709,8 @@ class AMPRenderer(HTMLParser):
         self.trim_attrs = False
         self.strip_comments = False
 
+        self._render_cache = {}
+
         # Always keep charrefs intact; This class is meant to reproduce HTML.
         self.convert_charrefs = False
 
@@ -533,40 +720,45 @@ class AMPRenderer(HTMLParser):
 
         self._remove_boilerplate = True
 
-        self._boilerplate = ""
+        self._boilerplate_parts = []
+        self._boilerplate_tag = _BOILERPLATE_OPEN + _STYLE_CLOSE
         self._is_in_boilerplate = False
-        self._boilerplate_index = None
+        self._has_boilerplate_slot = False
 
-        self._noscript_boilerplate = ""
+        self._noscript_boilerplate_parts = []
+        self._noscript_boilerplate_tag = _BOILERPLATE_OPEN + _STYLE_CLOSE
         self._is_in_noscript = False
-        self._noscript_boilerplate_index = None
+        self._has_noscript_boilerplate_slot = False
 
         self._is_expecting_experiment_script = False
         self._is_expecting_experiment_data = False
         self._is_expecting_experiment_end = False
-        self._current_experiment_data = ""
+        self._current_experiment_data_parts = []
 
         self._is_render_paused = False
         self._is_render_cancelled = False
 
-        self._result = []
+        self._result = io.StringIO()
+        self._result_write = self._result.write
+        self._add_data = self._add_to_result
         self._found_custom_element = False
         self._next_auto_id_num = 0
         self._translated_css_data = []
 
-        self._translated_styles_index = None
+        self._has_translated_styles_slot = False
 
-        with contextlib.suppress(AttributeError):
-            del self.no_boilerplate
+        self.__dict__.pop("no_boilerplate", None)
 
     def handle_decl(self, decl):
         """Process a declaration string."""
-        self._result.append(f"<!{decl.lower()}>")
+        self._result.write(f"<!{decl.lower()}>")
 
     def handle_starttag(self, tag, attrs):
         """Process a start tag."""
         tag = tag.lower()
 
+        attr_names = {attr[0] for attr in attrs}
+
         if self._is_expecting_experiment_data:
             # Expecting some JSON, found a start tag == NO EXPERIMENT
             self._apply_experiment_data()
@@ -580,6 +772,7 @@ class AMPRenderer(HTMLParser):
                         # Expecting script & found it; Next, we expect some
                         # JSON data.
                         self._is_expecting_experiment_data = True
+                        self._add_data = self._add_to_experiment
 
         if self._is_expecting_experiment_end:
             # Expecting </amp-experiment>, found a start tag == NO EXPERIMENT
@@ -588,21 +781,28 @@ class AMPRenderer(HTMLParser):
         if tag == "noscript":
             self._is_in_noscript = True
 
-        if tag == "style" and "amp-boilerplate" in {attr[0] for attr in attrs}:
+        if tag == "style" and "amp-boilerplate" in attr_names:
             self._is_in_boilerplate = True
 
+            if self._is_in_noscript:
+                self._add_data = self._add_to_noscript_boilerplate
+            else:
+                self._add_data = self._add_to_boilerplate
+
             # Add appropriate boilerplate placeholder
-            if self._is_in_noscript and self._noscript_boilerplate_index is None:
-                self._noscript_boilerplate_index = len(self._result)
-            elif self._boilerplate_index is None:
-                self._boilerplate_index = len(self._result)
+            if self._is_in_noscript and not self._has_noscript_boilerplate_slot:
+                self._has_noscript_boilerplate_slot = True
+                self._result.write(_NOSCRIPT_BOILERPLATE_PLACEHOLDER)
+            elif not self._has_boilerplate_slot:
+                self._has_boilerplate_slot = True
+                self._result.write(_BOILERPLATE_PLACEHOLDER)
 
             return
 
         safe_attrs = attrs
 
         if tag == "html":
-            if "i-amphtml-layout" in {attr[0] for attr in attrs}:
+            if "i-amphtml-layout" in attr_names:
                 # A simple check to see if it’s transformed already
                 self._is_render_cancelled = True
             else:
@@ -629,7 +829,7 @@ class AMPRenderer(HTMLParser):
             not self._is_render_cancelled
             and not self._is_render_paused
             and tag.startswith("amp-")
-            and "data-norender" not in {attr[0] for attr in attrs}
+            and "data-norender" not in attr_names
         )
 
         if tag == "amp-audio":
@@ -662,71 +862,32 @@ class AMPRenderer(HTMLParser):
             maybe_img_attrs = amp_element.maybe_img_attrs
 
         # Turn attribute data in to strings
-        attr_strings = []
-        for attr in safe_attrs:
-            attr_name = attr[0].lower()
-            if attr[1] is not None:
-                value = str(attr[1])
-                if self.trim_attrs:
-                    value = value.strip()
-                value = value.replace('"', "&quot;")
-                attr_strings.append(f' {attr_name}="{value}"')
-            else:
-                attr_strings.append(f" {attr_name}")
-
-        if self._is_test_mode:
-            # Sort alphabetically for diffing
-            attr_strings.sort()
+        attr_string = _serialize_attrs(
+            safe_attrs,
+            should_trim=self.trim_attrs,
+            should_sort=self._is_test_mode,
+        )
 
-        attr_string = "".join(attr_strings)
+        # Bind the write method once; this handler runs for every tag.
+        result_write = self._result.write
 
-        self._result.append(f"<{tag}{attr_string}>")
+        result_write(f"<{tag}{attr_string}>")
 
         # Add sizer if necessary
         if sizer:
-            sizer_attr_strings = []
-            for attr in sizer[0]:
-                attr_name = attr[0].lower()
-                if attr[1] is not None:
-                    value = str(attr[1])
-                    value = value.replace('"', "&quot;")
-                    sizer_attr_strings.append(f' {attr_name}="{value}"')
-                else:
-                    sizer_attr_strings.append(f" {attr_name}")
-            sizer_attr_string = "".join(sizer_attr_strings)
-
-            self._result.append(f"<i-amphtml-sizer{sizer_attr_string}>")
+            sizer_attr_string = _serialize_attrs(sizer[0])
+            result_write(f"<i-amphtml-sizer{sizer_attr_string}>")
 
             if sizer[1] is not None:
-                img_attr_strings = []
-                for attr in sizer[1]:
-                    attr_name = attr[0].lower()
-                    if attr[1] is not None:
-                        value = str(attr[1])
-                        value = value.replace('"', "&quot;")
-                        img_attr_strings.append(f' {attr_name}="{value}"')
-                    else:
-                        img_attr_strings.append(f" {attr_name}")
-                img_attr_string = "".join(img_attr_strings)
+                img_attr_string = _serialize_attrs(sizer[1])
+                result_write(f"<img{img_attr_string}>")
 
-                self._result.append(f"<img{img_attr_string}>")
-
-            self._result.append("</i-amphtml-sizer>")
+            result_write("</i-amphtml-sizer>")
 
         # Add img if necessary
         if maybe_img_attrs:
-            img_attr_strings = []
-            for attr in maybe_img_attrs:
-                attr_name = attr[0].lower()
-                if attr[1] is not None:
-                    value = str(attr[1])
-                    value = value.replace('"', "&quot;")
-                    img_attr_strings.append(f' {attr_name}="{value}"')
-                else:
-                    img_attr_strings.append(f" {attr_name}")
-            img_attr_string = "".join(img_attr_strings)
-
-            self._result.append(f"<img{img_attr_string}>")
+            img_attr_string = _serialize_attrs(maybe_img_attrs)
+            result_write(f"<img{img_attr_string}>")
 
         # Add runtime styles if necessary
         if tag == "head" and not self._is_render_cancelled:
@@ -740,18 +901,19 @@ class AMPRenderer(HTMLParser):
                     "<style amp-runtime"
                     + f' i-amphtml-version="{self.runtime_version}">{self.runtime_styles}</style>'
                 )
-            self._result.append(style)
+            result_write(style)
 
         if tag == "style":
             # Insert a placeholder into <style amp-custom> so we can add in
             # the transformed styles later.
             has_custom_element = (
-                "amp-custom" in {attr[0] for attr in attrs}
-                and self._translated_styles_index is None
+                "amp-custom" in attr_names
+                and not self._has_translated_styles_slot
             )
             if has_custom_element:
                 self._found_custom_element = True
-                self._translated_styles_index = len(self._result)
+                self._has_translated_styles_slot = True
+                result_write(_TRANSLATED_STYLES_PLACEHOLDER)
 
     def handle_endtag(self, tag):
         """Process a closing tag."""
@@ -788,12 +950,14 @@ class AMPRenderer(HTMLParser):
 
         if tag == "style" and self._is_in_boilerplate:
             self._is_in_boilerplate = False
+            self._add_data = self._add_to_result
+            self._finalize_boilerplate()
             return
 
         is_missing_custom_element = (
             tag == "head"
             and not self._found_custom_element
-            and self._translated_styles_index is None
+            and not self._has_translated_styles_slot
         )
         if is_missing_custom_element:
             # If there was no custom element found in the head, add the
@@ -801,12 +965,13 @@ class AMPRenderer(HTMLParser):
             # later. `self._found_custom_element` will remain False, and we’ll
             # inspect that later to decide whether the <script> element itself
             # needs to be added.
-            self._translated_styles_index = len(self._result)
+            self._has_translated_styles_slot = True
+            self._result.write(_TRANSLATED_STYLES_PLACEHOLDER)
 
         if tag in {"template", "script"}:
             self._is_render_paused = False
 
-        self._result.append(f"</{tag}>")
+        self._result.write(f"</{tag}>")
 
     def handle_data(self, html_data):
         """Process HTML data."""
@@ -823,124 +988,192 @@ class AMPRenderer(HTMLParser):
     def handle_comment(self, comment):
         """Process an HTML comment."""
         if not self.strip_comments:
-            self._result.append(f"<!--{comment}-->")
+            self._result.write(f"<!--{comment}-->")
 
     def render(self, amp_html):
-        """Run the server-side-rendering routine."""
+        """Run the server-side-rendering routine.
+
+        Template engines tend to re-render identical documents, so results
+        are memoized per instance, keyed on a digest of the input plus the
+        settings that shape the output. Hashing keeps the keys small, but
+        note the cache still retains up to _RENDER_CACHE_SIZE rendered
+        documents in memory.
+        """
+        cache_key = (
+            hashlib.blake2b(amp_html.encode("utf-8"), digest_size=16).digest(),
+            self.trim_attrs,
+            self.strip_comments,
+            self.runtime_styles,
+            self.runtime_version,
+        )
+        cached = self._render_cache.get(cache_key)
+        if cached is not None:
+            self.no_boilerplate = cached[1]
+            return cached[0]
+
+        rendered = self._render(amp_html)
+
+        if len(self._render_cache) >= _RENDER_CACHE_SIZE:
+            # Evict the oldest entry; dicts preserve insertion order.
+            self._render_cache.pop(next(iter(self._render_cache)))
+        self._render_cache[cache_key] = (rendered, self.no_boilerplate)
+
+        return rendered
+
+    def _render(self, amp_html):
         self.reset()
 
+        # Sorted so that `_increment_auto_id_num` can skip runs of
+        # conflicting ids with a monotonically advancing pointer. The
+        # substring guard skips the regex scan entirely for the usual
+        # conflict-free document.
         self._auto_id_nums_to_ignore = []
-
-        conflict_ids = re.findall("id=['\"]?{}([0-9]+)['\"]?".format(ID_PREFIX), amp_html)
-        for conflict_id in conflict_ids:
-            self._auto_id_nums_to_ignore.append(int(conflict_id))
+        if ID_PREFIX in amp_html:
+            conflict_ids = _CONFLICT_ID_RE.findall(amp_html)
+            self._auto_id_nums_to_ignore = sorted({int(num) for num in conflict_ids})
+        self._ignore_index = 0
 
         self.feed(amp_html)
         self.close()
 
-        # Combine translated styles by media query and value when possible
-        media_batches = OrderedDict()
-
-        for selector, statements in self._translated_css_data:
+        # Fast path: nothing was deferred during parsing, so skip the CSS
+        # assembly and placeholder resolution entirely.
+        if not (
+            self._translated_css_data
+            or self._has_translated_styles_slot
+            or self._has_boilerplate_slot
+            or self._has_noscript_boilerplate_slot
+        ):
+            result = self._result.getvalue()
+
+            if self._is_render_cancelled or not self._remove_boilerplate:
+                self.no_boilerplate = False
+                return _CLEANUP_RE.sub("", result)
+
+            self.no_boilerplate = True
+            return result.replace(_EMPTY_NOSCRIPT, "")
+
+        # Combine translated styles by media query and value when possible;
+        # Grouping is keyed on the whole document so interleaved elements
+        # that share a batch and query still merge into one block. The
+        # inner dicts act as ordered sets, so duplicate selectors drop out
+        # at insertion time.
+        grouped_batches = defaultdict(dict)
+
+        translated_css_data = self._translated_css_data
+        for selector, statements in translated_css_data:
             media_batch_key = tuple(statements.keys())
-            batch = media_batches.get(media_batch_key) or OrderedDict()
 
             for query, statement_value in statements.items():
-                value_dict = batch.get(query) or OrderedDict()
-
-                selector_list = value_dict.get(statement_value) or []
-                selector_list.append(selector)
-                value_dict[statement_value] = selector_list
-
-                batch[query] = value_dict
-
-            media_batches[media_batch_key] = batch
+                # Declarations repeat heavily across elements; interning
+                # them gives pointer-fast hashing and comparison.
+                statement_value = sys.intern(statement_value)
+                batch_rules = grouped_batches[(media_batch_key, query)]
+                batch_rules.setdefault(statement_value, {})[selector] = None
 
         css_parts = []
-        for batch in media_batches.values():
-            for query, values in batch.items():
-                parts = []
-
-                for key, value in values.items():
-                    selector = ",".join(value)
-                    parts.append(f"{selector}{{{key}}}")
+        css_parts_append = css_parts.append
+        for (_, query), batch_rules in grouped_batches.items():
+            # Emit the @media brackets around the group instead of building
+            # and re-wrapping an intermediate string.
+            if query:
+                css_parts_append(f"@media {query}{{")
 
-                css = "".join(parts)
-                if query:
-                    css = f"@media {query}{{{css}}}"
+            for statement_value, selectors in batch_rules.items():
+                css_parts_append(f"{','.join(selectors)}{{{statement_value}}}")
 
-                css_parts.append(css)
+            if query:
+                css_parts_append("}")
 
         style_string = "".join(css_parts)
 
         if style_string and not self._found_custom_element:
             # Insert the amp-custom tag if necessary
-            style_string = f"<style amp-custom>{style_string}</style>"
+            style_string = _AMP_CUSTOM_OPEN + style_string + _STYLE_CLOSE
 
-        if self._translated_styles_index is not None:
-            self._result.insert(self._translated_styles_index, style_string)
-
-            if self._translated_styles_index <= (self._boilerplate_index or 0):
-                self._boilerplate_index += 1
-
-            if self._translated_styles_index <= (self._noscript_boilerplate_index or 0):
-                self._noscript_boilerplate_index += 1
-
-        self.no_boilerplate = True
+        # Resolve every placeholder and cleanup marker in one left-to-right
+        # pass instead of re-scanning the whole document per substitution.
         if self._is_render_cancelled or not self._remove_boilerplate:
             self.no_boilerplate = False
+            replacements = {
+                _TRANSLATED_STYLES_PLACEHOLDER: style_string,
+                # Restore the boilerplate
+                _BOILERPLATE_PLACEHOLDER: self._boilerplate_tag,
+                _WRAPPED_NOSCRIPT_PLACEHOLDER: (
+                    "<noscript>" + self._noscript_boilerplate_tag + "</noscript>"
+                ),
+                _NOSCRIPT_BOILERPLATE_PLACEHOLDER: self._noscript_boilerplate_tag,
+                _NO_BOILERPLATE_MARKER: "",
+                _EMPTY_NOSCRIPT: "",
+            }
+        else:
+            self.no_boilerplate = True
+            replacements = {
+                _TRANSLATED_STYLES_PLACEHOLDER: style_string,
+                # The boilerplate stays removed; blank any placeholders but
+                # keep the no-boilerplate class on the html tag
+                _BOILERPLATE_PLACEHOLDER: "",
+                _WRAPPED_NOSCRIPT_PLACEHOLDER: "",
+                _NOSCRIPT_BOILERPLATE_PLACEHOLDER: "",
+                _NO_BOILERPLATE_MARKER: _NO_BOILERPLATE_MARKER,
+                # Remove empty noscript tags; This happens when removing
+                # boilerplate
+                _EMPTY_NOSCRIPT: "",
+            }
+
+        return _FINALIZE_RE.sub(
+            lambda match: replacements[match.group(0)],
+            self._result.getvalue(),
+        )
 
-            # Restore the boilerplate
-            if self._boilerplate_index is not None:
-                boilerplate = f"<style amp-boilerplate>{self._boilerplate}</style>"
-                self._result.insert(self._boilerplate_index, boilerplate)
-
-                if self._boilerplate_index <= (self._noscript_boilerplate_index or 0):
-                    self._noscript_boilerplate_index += 1
-
-            if self._noscript_boilerplate_index is not None:
-                noscript_boilerplate = (
-                    f"<style amp-boilerplate>{self._noscript_boilerplate}</style>"
-                )
-                self._result.insert(self._noscript_boilerplate_index, noscript_boilerplate)
-
-        result = "".join(self._result)
-
-        if self._is_render_cancelled or not self._remove_boilerplate:
-            result = result.replace(" i-amphtml-no-boilerplate", "")
+    # `_add_data` is rebound to one of these single-purpose sinks whenever
+    # the parser changes modes, so the hottest call has no branches at all.
+    def _add_to_result(self, html_data):
+        self._result_write(html_data)
 
-        # Remove empty noscript tags; This happens when removing boilerplate
-        return result.replace("<noscript></noscript>", "")
+    def _add_to_boilerplate(self, html_data):
+        self._boilerplate_parts.append(html_data)
 
-    def _add_data(self, html_data):
-        if self._is_in_boilerplate:
-            if self._is_in_noscript:
-                self._noscript_boilerplate += html_data
-                return
+    def _add_to_noscript_boilerplate(self, html_data):
+        self._noscript_boilerplate_parts.append(html_data)
 
-            self._boilerplate += html_data
-            return
+    def _add_to_experiment(self, html_data):
+        self._current_experiment_data_parts.append(html_data)
 
-        if self._is_expecting_experiment_data:
-            self._current_experiment_data += html_data
-            return
-
-        self._result.append(html_data)
+    def _finalize_boilerplate(self):
+        # The accumulated boilerplate doesn't change after its closing tag,
+        # so wrap it in its style tag once rather than on every render.
+        if self._is_in_noscript:
+            noscript_boilerplate = "".join(self._noscript_boilerplate_parts)
+            self._noscript_boilerplate_tag = (
+                _BOILERPLATE_OPEN + noscript_boilerplate + _STYLE_CLOSE
+            )
+        else:
+            boilerplate = "".join(self._boilerplate_parts)
+            self._boilerplate_tag = _BOILERPLATE_OPEN + boilerplate + _STYLE_CLOSE
 
     def _get_next_auto_id(self):
-        return ID_PREFIX + str(self._next_auto_id_num)
+        return f"{ID_PREFIX}{self._next_auto_id_num}"
 
     def _increment_auto_id_num(self):
-        self._next_auto_id_num += 1
-        while self._next_auto_id_num in self._auto_id_nums_to_ignore:
-            self._next_auto_id_num += 1
+        ignore = self._auto_id_nums_to_ignore
+        ignore_index = self._ignore_index
 
-    def _apply_experiment_data(self):
-        self._result.append(self._current_experiment_data)
+        next_num = self._next_auto_id_num + 1
+        while ignore_index < len(ignore) and ignore[ignore_index] <= next_num:
+            if ignore[ignore_index] == next_num:
+                next_num += 1
+            ignore_index += 1
 
-        experiment_data = self._current_experiment_data
+        self._next_auto_id_num = next_num
+        self._ignore_index = ignore_index
+
+    def _apply_experiment_data(self):
+        experiment_data = "".join(self._current_experiment_data_parts)
+        self._result.write(experiment_data)
 
-        self._current_experiment_data = ""
+        self._current_experiment_data_parts = []
         self._is_expecting_experiment_data = False
+        self._add_data = self._add_to_result
 
         return experiment_data
@@ -95,3 +95,66 @@ class TestRenderer:
 
         assert result == expected_result
         assert renderer.no_boilerplate
+
+
+class TestRenderCache:
+    """Test the per-instance render memoization."""
+
+    basic_html = "<div data-test-attribute=' Lovely!  '>Hello there!<!-- Bye. --></div>"
+
+    def test_hit_returns_same_result(self):
+        """Test that re-rendering identical input returns the cached result."""
+        renderer = RendererFactory.make()
+        first = renderer.render(self.basic_html)
+        second = renderer.render(self.basic_html)
+
+        assert second is first
+
+    def test_trim_attrs_invalidates(self):
+        """Test that changing trim_attrs forces a re-render."""
+        renderer = RendererFactory.make()
+        untrimmed = renderer.render(self.basic_html)
+
+        renderer.trim_attrs = True
+        trimmed = renderer.render(self.basic_html)
+
+        assert trimmed != untrimmed
+        assert 'data-test-attribute="Lovely!"' in trimmed
+
+    def test_strip_comments_invalidates(self):
+        """Test that changing strip_comments forces a re-render."""
+        renderer = RendererFactory.make()
+        unstripped = renderer.render(self.basic_html)
+
+        renderer.strip_comments = True
+        stripped = renderer.render(self.basic_html)
+
+        assert stripped != unstripped
+        assert "<!--" not in stripped
+
+    def test_runtime_styles_invalidate(self):
+        """Test that changing the runtime styles forces a re-render."""
+        renderer = RendererFactory.make()
+        amp_html = "<html ⚡><head></head><body></body></html>"
+        original = renderer.render(amp_html)
+
+        renderer.runtime_styles = "body{background-color:blue;}"
+        updated = renderer.render(amp_html)
+
+        assert updated != original
+        assert "body{background-color:blue;}" in updated
+
+    def test_no_boilerplate_restored_on_hit(self):
+        """Test that a cache hit restores the no_boilerplate flag."""
+        removable = "<html ⚡><head></head><body></body></html>"
+        unremovable = "<html ⚡><head></head><body><amp-audio></amp-audio></body></html>"
+
+        renderer = RendererFactory.make()
+        renderer.render(removable)
+        assert renderer.no_boilerplate
+
+        renderer.render(unremovable)
+        assert not renderer.no_boilerplate
+
+        renderer.render(removable)
+        assert renderer.no_boilerplate